@@ -495,6 +495,13 @@ def add_args(parser):
         help="minimum number of gammas over which to search for each sampler (if doing in parallel, we may do more if we have more CPUs than this)",
     )
     args2config.update({"mcmc_num_samplers": ["mcmc", "num_samplers"]})
+    parser.add_argument(
+        "--mcmc_num_threads",
+        type=int,
+        default=1,
+        help="split the samplers into this many groups which run concurrently in threads",
+    )
+    args2config.update({"mcmc_num_threads": ["mcmc", "num_threads"]})
     parser.add_argument("--stun_min_gamma", type=float, default=-3)
     args2config.update({"stun_min_gamma": ["mcmc", "stun_min_gamma"]})
     parser.add_argument("--stun_max_gamma", type=float, default=1)
@@ -157,8 +157,11 @@ class Querier():
 
         if method.lower() == "mcmc":
             gammas = np.logspace(self.config.mcmc.stun_min_gamma, self.config.mcmc.stun_max_gamma, self.config.mcmc.num_samplers)
-            self.mcmcSampler = Sampler(self.config, seedInd, scoreFunction, gammas)
-            samples = self.mcmcSampler.sample(model, useOracle=useOracle)
+            if self.config.mcmc.num_threads > 1: # run groups of gammas as concurrent samplers
+                samples = parallelSample(self.config, seedInd, scoreFunction, gammas, model, self.config.mcmc.num_threads, useOracle=useOracle)
+            else:
+                self.mcmcSampler = Sampler(self.config, seedInd, scoreFunction, gammas)
+                samples = self.mcmcSampler.sample(model, useOracle=useOracle)
             outputs = samples2dict(samples)
 
         elif method.lower() == "random":
@@ -2,6 +2,7 @@
 from utils import *
 from oracle import *
 import tqdm
+from concurrent.futures import ThreadPoolExecutor
 
 '''
 This script uses Markov Chain Monte Carlo, including the STUN algorithm, to optimize a given function
@@ -18,31 +19,37 @@ class Sampler:
     intrinsically parallel, rather than via multiprocessing
     """
 
-    def __init__(self, config, seedInd, scoreFunction, gammas):
+    def __init__(self, config, seedInd, scoreFunction, gammas, rngStream = 0):
         self.config_main = config
         self.config_main.STUN = 1
         self.config_main.target_acceptance_rate = 0.234 # found this in a paper
         self.chainLength = self.config_main.dataset.max_length
         self.deltaIter = int(10)  # get outputs every this many of iterations with one iteration meaning one move proposed for each "particle" on average
-        self.randintsResampleAt = int(1e4)  # larger takes up more memory but increases speed
+        self.randomBufferBytes = int(2 ** 20)  # memory budget for the pre-drawn random numbers - roughly one L2 cache
         self.scoreFunction = scoreFunction
         self.seedInd = seedInd
         self.recordMargin = 0.2  # how close does a state have to be to the best found minimum to be recorded
-        self.gammas = gammas
+        self.swapInterval = int(1)  # attempt parallel-tempering swaps between neighbouring chains every this many iterations
+        self.gammas = np.asarray(gammas, dtype=np.float32) # sampling runs in float32 - acceptance only needs a few digits of precision
         self.nruns = len(gammas)
+        self.chainInds = np.arange(self.nruns) # row index of every chain, for vectorized updates
+        self.randintsResampleAt = self.getResampleLength()  # larger takes up more memory but increases speed
+        self.expRandoms = np.empty((self.randintsResampleAt, self.nruns), dtype=np.float32).T # float random numbers are refilled in place, transposed like the other buffers
         self.temp0 = 0.1 # initial temperature for sampling runs
-        self.temperature = [self.temp0 for _ in range(self.nruns)]
+        self.temperature = np.full(self.nruns, self.temp0, dtype=np.float32)
 
 
         if self.config_main.dataset.type == 'toy':
             self.oracle = Oracle(self.config_main)  # if we are using a toy model, initialize the oracle so we can optimize it directly for comparison
 
-        np.random.seed(int(self.config_main.seeds.sampler + int(self.seedInd * 1000))) # initial seed is randomized over pipeline iterations
+        seed = int(self.config_main.seeds.sampler + int(self.seedInd * 1000)) # initial seed is randomized over pipeline iterations
+        np.random.seed(seed)
+        self.rng = np.random.default_rng([seed, rngStream]) # PCG64 generator for all of the sampler's own random numbers - samplers running side by side use different streams
 
-        self.getInitConfig()
+        self.optimaInitialized = False # E0 and the optima records are set up on the first sampling step
+        self.proposeConfigs = self.propConfigsVariableLength if self.config_main.dataset.variable_length else self.propConfigs # pick the proposal step once, rather than branching every iteration
 
-        if self.config_main.debug:
-            self.initRecs()
+        self.getInitConfig()
 
 
     def __call__(self, model):
@@ -54,11 +61,8 @@ class Sampler:
         get initial condition
         :return:
         """
-        self.config = []
-        for i in range(self.nruns):
-            self.config.append(self.makeAConfig())
-
-        self.config = np.asarray(self.config)
+        self.config = np.stack([self.makeAConfig() for i in range(self.nruns)]) # uint8 - the alphabet is tiny
+        self.currentScoresValid = False # no cached scores for these configs yet
 
 
     def makeAConfig(self):
@@ -68,14 +72,14 @@ class Sampler:
         '''
 
         if self.config_main.dataset.variable_length:
-            randChainLen = np.random.randint(self.config_main.dataset.min_length,self.config_main.dataset.max_length)
-            randConfig = np.random.randint(1, self.config_main.dataset.dict_size + 1, size = (1, randChainLen))
+            randChainLen = self.rng.integers(self.config_main.dataset.min_length,self.config_main.dataset.max_length)
+            randConfig = self.rng.integers(1, self.config_main.dataset.dict_size + 1, size = (1, randChainLen), dtype=np.uint8)
             if randChainLen < self.config_main.dataset.max_length: # add zero padding, if necessary
                 randConfig = np.pad(randConfig[0],[0, self.config_main.dataset.max_length - randChainLen],mode='constant')
         else:
-            randConfig = np.random.randint(1,self.config_main.dataset.dict_size + 1, size = (self.config_main.dataset.max_length))
+            randConfig = self.rng.integers(1,self.config_main.dataset.dict_size + 1, size = (self.config_main.dataset.max_length), dtype=np.uint8)
 
-        return randConfig
+        return randConfig.astype(np.uint8, copy=False)
 
     def resetConfig(self,ind):
         """
@@ -84,6 +88,7 @@ class Sampler:
         """
 
         self.config[ind,:] = self.makeAConfig()
+        self.currentScoresValid = False # this config needs rescoring
 
 
     def resampleRandints(self):
@@ -91,11 +96,22 @@ class Sampler:
         periodically resample our relevant random numbers
         :return:
         """
-        self.spinRandints = np.random.randint(1, self.config_main.dataset.dict_size + 1, size=(self.nruns,self.randintsResampleAt)).astype('uint8')
-        self.pickSpinRandint = np.random.randint(0, self.chainLength, size=(self.nruns,self.randintsResampleAt)).astype('uint32')
-        self.alphaRandoms = np.random.random((self.nruns,self.randintsResampleAt)).astype(float)
-        self.changeLengthRandints = np.random.randint(-1, 2, size=(self.nruns,self.randintsResampleAt)).astype('int8')
-        self.seqExtensionRandints = np.random.randint(1, self.config_main.dataset.dict_size + 1, size=(self.nruns,self.randintsResampleAt)).astype('uint8')
+        # draw as (steps, nruns) and keep transposed views, so the [:, ind] column read at each step is contiguous in memory
+        shape = (self.randintsResampleAt, self.nruns)
+        self.spinRandints = self.rng.integers(1, self.config_main.dataset.dict_size + 1, size=shape, dtype=np.uint8).T # integers are drawn directly in their final dtype
+        self.pickSpinRandint = self.rng.integers(0, self.chainLength, size=shape, dtype=np.uint32).T
+        self.changeLengthRandints = self.rng.integers(-1, 2, size=shape, dtype=np.int8).T
+        self.seqExtensionRandints = self.rng.integers(1, self.config_main.dataset.dict_size + 1, size=shape, dtype=np.uint8).T
+
+        self.rng.standard_exponential(dtype=np.float32, out=self.expRandoms.T) # -log(u) for uniform u, so Metropolis tests need no exp or log
+
+    def getResampleLength(self):
+        """
+        number of steps' worth of random numbers to draw at once, sized so all the buffers fit in randomBufferBytes
+        :return:
+        """
+        bytesPerStep = self.nruns * 11 # uint8 + uint32 + int8 + uint8 + float32 per chain per step
+        return int(np.clip(self.randomBufferBytes // bytesPerStep, 1024, 1e4))
 
 
     def initOptima(self, scores, energy, variance):
@@ -108,42 +124,46 @@ class Sampler:
         self.varAtOptima = [[] for i in range(self.nruns)]  # record of uncertainty at the optima
         self.optimalSamples = [[] for i in range(self.nruns)]  # record the optimal samples
         self.optimalInds = [[] for i in range(self.nruns)]
-        self.recInds = [[] for i in range(self.nruns)]
-        self.newOptima = [[] for i in range(self.nruns)] # new minima
-        self.newOptimaEn = [[] for i in range(self.nruns)] # new minima
+        self.lastOptimalInd = np.zeros(self.nruns, dtype=int) # iteration at which each chain last found a new minimum
+        self.newOptima = np.zeros((self.nruns, 16, self.config.shape[-1]), dtype=np.uint8) # new minima, per chain - grown as needed
+        self.newOptimaEn = np.zeros((self.nruns, 16), dtype=np.float32) # energies of the new minima
+        self.newOptimaCount = np.zeros(self.nruns, dtype=int) # how many new minima each chain has recorded
         self.allOptimalConfigs = []
+        self.allOptimalKeys = set() # raw bytes of every recorded optimum, for O(1) duplicate checks
 
 
         # set initial values
+        self.optimaInitialized = True
         self.E0 = scores[1]  # initialize the 'best score' value
         self.absMin = min(self.E0)
         for i in range(self.nruns):
             self.optima[i].append(scores[1][i])
             self.enAtOptima[i].append(energy[1][i])
             self.varAtOptima[i].append(variance[1][i])
-            self.newOptima[i].append(self.config[i])
-            self.newOptimaEn[i].append(energy[1][i])
-            self.optimalSamples[i].append(self.config[i])
+            self.recordNewOptimum(i, self.config[i], energy[1][i])
+            self.optimalSamples[i].append(np.copy(self.config[i])) # copy - config is updated in place
             self.optimalInds[i].append(0)
 
 
-    def initRecs(self):
+    def initRecs(self, run_iters):
         '''
-        step-by-step records for debugging purposes
+        step-by-step records for debugging purposes, preallocated as (nruns, run_iters)
         :return:
         '''
-        self.temprec = [[] for i in range(self.nruns)]
-        self.accrec = [[] for i in range(self.nruns)]
-        self.stunrec = [[] for i in range(self.nruns)]
-        self.scorerec = [[] for i in range(self.nruns)]
-        self.enrec = [[] for i in range(self.nruns)]
-        self.varrec = [[] for i in range(self.nruns)]
+        self.temprec = np.zeros((self.nruns, run_iters), dtype=np.float32)
+        self.accrec = np.zeros((self.nruns, run_iters), dtype=np.float32)
+        self.stunrec = np.zeros((self.nruns, run_iters), dtype=np.float32)
+        self.scorerec = np.zeros((self.nruns, run_iters), dtype=np.float32)
+        self.enrec = np.zeros((self.nruns, run_iters), dtype=np.float32)
+        self.varrec = np.zeros((self.nruns, run_iters), dtype=np.float32)
 
 
     def initConvergenceStats(self):
         # convergence stats
-        self.resetInd = [0 for i in range(self.nruns)]  # flag
+        self.resetInd = np.zeros(self.nruns, dtype=int)  # flag
         self.acceptanceRate = np.zeros(self.nruns) # rolling MCMC acceptance rate
+        self.acceptanceHistory = 100 # number of iterations over which the rolling acceptance rate is computed
+        self.acceptedBuf = np.zeros((self.nruns, self.acceptanceHistory), dtype=bool) # circular buffer of recent accept/reject outcomes
 
 
     def computeSTUN(self, scores):
@@ -171,13 +191,19 @@ class Sampler:
         """
         self.initConvergenceStats()
         self.resampleRandints()
+        self.currentScoresValid = False # cached scores may come from a different model
         if nIters is None:
             run_iters = self.config_main.mcmc.sampling_time
         else:
             run_iters = nIters
+        if self.config_main.debug:
+            self.initRecs(run_iters)
         for self.iter in tqdm.tqdm(range(run_iters)):  # sample for a certain number of iterations
             self.iterate(model, useOracle)  # try a monte-carlo step!
 
+            if (self.iter % self.swapInterval == 0) and (self.nruns > 1):
+                self.swapConfigs()  # exchange states between neighbouring chains
+
             if (self.iter % self.deltaIter == 0) and (self.iter > 0):  # every N iterations do some reporting / updating
                 self.updateAnnealing()  # change temperature or other conditions
 
@@ -197,26 +223,32 @@ class Sampler:
         '''
         self.config_main.STUN = 0
         self.nruns = len(initConfigs)
+        self.chainInds = np.arange(self.nruns)
+        self.randintsResampleAt = self.getResampleLength()
+        self.expRandoms = np.empty((self.randintsResampleAt, self.nruns), dtype=np.float32).T
         self.temp0 = 0.01 # initial temperature for sampling runs
-        self.temperature = [self.temp0 for _ in range(self.nruns)]
-        self.config = initConfigs # manually overwrite configs
+        self.temperature = np.full(self.nruns, self.temp0, dtype=np.float32)
+        self.config = np.asarray(initConfigs).astype(np.uint8) # manually overwrite configs
+        self.currentScoresValid = False
 
         self.initConvergenceStats()
         self.resampleRandints()
+        if self.config_main.debug:
+            self.initRecs(self.config_main.gflownet.post_annealing_time)
         for self.iter in tqdm.tqdm(range(self.config_main.gflownet.post_annealing_time)):
             self.iterate(model, useOracle)
 
-            self.temperature = [temperature * 0.99 for temperature in self.temperature] # cut temperature at every time step
+            self.temperature *= 0.99 # cut temperature at every time step
 
             if self.iter % self.randintsResampleAt == 0: # periodically resample random numbers
                 self.resampleRandints()
 
-        evals = self.getScores(self.config, self.config, model, useOracle=False)
+        evals = self.scoreConfigs(self.config, model, useOracle=False)
         annealedOutputs = {
             'samples': self.config,
-            'scores': evals[0][0],
-            'energies': evals[1][0],
-            'uncertainties': evals[2][0]
+            'scores': evals[0],
+            'energies': evals[1],
+            'uncertainties': evals[2]
         }
 
         return annealedOutputs
@@ -229,21 +261,23 @@ class Sampler:
         :return:
         """
         self.propConfig = np.copy(self.config)
-        for i in range(self.nruns):
-            self.propConfig[i, self.pickSpinRandint[i,ind]] = self.spinRandints[i,ind]
-
-            # propose changing sequence length
-            if self.config_main.dataset.variable_length:
-                if self.changeLengthRandints[i,ind] == 0:  # do nothing
-                    pass
-                else:
-                    nnz = np.count_nonzero(self.propConfig[i])
-                    if self.changeLengthRandints[i,ind] == 1:  # extend sequence by adding a new spin (nonzero element)
-                        if nnz < self.config_main.dataset.max_length:
-                            self.propConfig[i, nnz] = self.seqExtensionRandints[i, ind]
-                    elif nnz == -1:  # shorten sequence by trimming the end (set last element to zero)
-                        if nnz > self.config_main.dataset.min_length:
-                            self.propConfig[i, nnz - 1] = 0
+        self.propConfig[self.chainInds, self.pickSpinRandint[:, ind]] = self.spinRandints[:, ind] # mutate one spin on every chain at once
+
+    def propConfigsVariableLength(self,ind):
+        """
+        propose a new ensemble of configurations, also proposing changes to the sequence lengths
+        :param ind:
+        :return:
+        """
+        self.propConfigs(ind)
+
+        nnz = np.count_nonzero(self.propConfig, axis=1) # sequence length of every chain in one call
+
+        rows = np.nonzero((self.changeLengthRandints[:, ind] == 1) & (nnz < self.config_main.dataset.max_length))[0]  # extend sequence by adding a new spin (nonzero element)
+        self.propConfig[rows, nnz[rows]] = self.seqExtensionRandints[rows, ind]
+
+        rows = np.nonzero((self.changeLengthRandints[:, ind] == -1) & (nnz > self.config_main.dataset.min_length))[0]  # shorten sequence by trimming the end (set last element to zero)
+        self.propConfig[rows, nnz[rows] - 1] = 0
 
     def iterate(self, model, useOracle):
         """
@@ -254,19 +288,22 @@ class Sampler:
         self.ind = self.iter % self.randintsResampleAt # random number index
 
         # propose a new state
-        self.propConfigs(self.ind)
+        self.proposeConfigs(self.ind)
 
         # even if it didn't change, just run it anyway (big parallel - to hard to disentangle)
         # compute acceptance ratio
-        self.scores, self.energy, self.variance = self.getScores(self.propConfig, self.config, model, useOracle)
+        if self.currentScoresValid: # scores of the current configs are cached from the last step, only evaluate the proposals
+            propScores, propEnergy, propVariance = self.scoreConfigs(self.propConfig, model, useOracle)
+            self.scores = np.stack((propScores, self.currentScores))
+            self.energy = np.stack((propEnergy, self.currentEnergy))
+            self.variance = np.stack((propVariance, self.currentVariance))
+        else:
+            self.scores, self.energy, self.variance = self.getScores(self.propConfig, self.config, model, useOracle)
 
-        try:
-            self.E0
-        except:
+        if not self.optimaInitialized:
             self.initOptima(self.scores, self.energy, self.variance)  # if we haven't already assigned E0, initialize everything
 
-        self.F, self.DE = self.getDE(self.scores)
-        self.acceptanceRatio = np.minimum(1, np.exp(-self.DE / self.temperature))
+        self.DE = self.getDE(self.scores)
         self.updateConfigs()
 
     def updateConfigs(self):
@@ -274,41 +311,67 @@ class Sampler:
         check Metropolis conditions, update configurations, and record statistics
         :return:
         '''
-        # accept or reject
-        for i in range(self.nruns):
-            if self.alphaRandoms[i, self.ind] < self.acceptanceRatio[i]:  # accept
-                self.config[i] = np.copy(self.propConfig[i])
-                self.recInds[i].append(self.iter)
+        # accept or reject, all chains at once - u < exp(-DE/T) is equivalent to DE < -T*log(u)
+        accept = self.DE < self.temperature * self.expRandoms[:, self.ind]
+        self.config[accept] = self.propConfig[accept]
+        self.acceptedBuf[:, self.iter % self.acceptanceHistory] = accept
+
+        # cache scores of each chain's current config for the next step
+        self.currentScores = np.where(accept, self.scores[0], self.scores[1])
+        self.currentEnergy = np.where(accept, self.energy[0], self.energy[1])
+        self.currentVariance = np.where(accept, self.variance[0], self.variance[1])
+        self.currentScoresValid = True
 
-                newBest = False
-                if (self.scores[0][i] < self.E0[i]):
-                    newBest = True
-                if newBest or ((self.E0[i] - self.scores[0][i]) / self.E0[i] < self.recordMargin):  # if we have a new minimum on this trajectory, record it  # or if near a minimum
-                    self.saveOptima(i, newBest)
+        newBest = self.scores[0] < self.E0
+        nearMin = (self.E0 - self.scores[0]) / self.E0 < self.recordMargin
+        for i in np.nonzero(accept & (newBest | nearMin))[0]:  # if we have a new minimum on this trajectory, record it  # or if near a minimum
+            self.saveOptima(i, newBest[i])
 
 
         if self.config_main.debug: # record a bunch of detailed outputs
             self.recordStats()
 
+    def swapConfigs(self):
+        '''
+        parallel tempering - propose swapping the states of neighbouring chains (ordered by gamma)
+        alternate between even and odd pairs so every neighbouring pair gets a chance
+        chains differ in temperature and STUN gamma, so each side of the swap is scored under its own chain's energy function
+        :return:
+        '''
+        left = np.arange((self.iter // self.swapInterval) % 2, self.nruns - 1, 2)
+        right = left + 1
+        partner = np.arange(self.nruns)
+        partner[left], partner[right] = right, left
+
+        DE = self.getDE(np.stack((self.currentScores[partner], self.currentScores)))  # energy change for each chain if it took its partner's state
+        DE = DE / self.temperature
+        logA = -(DE[left] + DE[right])
+
+        swap = -self.rng.standard_exponential(len(left)) < logA # log of a uniform random number
+        inds = np.concatenate((left[swap], right[swap]))
+        swapped = np.concatenate((right[swap], left[swap]))
+        self.config[inds] = self.config[swapped]
+        self.currentScores[inds] = self.currentScores[swapped]
+        self.currentEnergy[inds] = self.currentEnergy[swapped]
+        self.currentVariance[inds] = self.currentVariance[swapped]
+        self.E0[inds] = self.E0[swapped]
+
     def getDE(self, scores):
-        if self.config_main.STUN == 1:  # compute score difference using STUN
-            F = self.computeSTUN(scores)
-            DE = F[0] - F[1]
+        if self.config_main.STUN == 1:  # compute score difference using STUN - the 1's cancel, so difference the exponentials directly
+            DE = np.exp(-self.gammas * (scores[1] - self.absMin)) - np.exp(-self.gammas * (scores[0] - self.absMin))
         else:  # compute raw score difference
-            F = [0, 0]
             DE = scores[0] - scores[1]
 
-        return F, DE
+        return DE
 
     def recordStats(self):
-        for i in range(self.nruns):
-            self.temprec[i].append(self.temperature[i])
-            self.accrec[i].append(self.acceptanceRate[i])
-            self.scorerec[i].append(self.scores[0][i])
-            self.enrec[i].append(self.energy[0][i])
-            self.varrec[i].append(self.variance[0][i])
-            if self.config_main.STUN:
-                self.stunrec[i].append(self.F[0][i])
+        self.temprec[:, self.iter] = self.temperature
+        self.accrec[:, self.iter] = self.acceptanceRate
+        self.scorerec[:, self.iter] = self.scores[0]
+        self.enrec[:, self.iter] = self.energy[0]
+        self.varrec[:, self.iter] = self.variance[0]
+        if self.config_main.STUN:
+            self.stunrec[:, self.iter] = self.computeSTUN(self.scores[0])
 
     def getScores(self, propConfig, config, model, useOracle):
         """
@@ -317,44 +380,68 @@ class Sampler:
         :param config:
         :return:
         """
+        nProp = len(propConfig)
+        score, energy, variance = self.scoreConfigs(np.concatenate((propConfig, config), axis=0), model, useOracle) # evaluate propConfig and config in a single batch, then split
+
+        return np.stack((score[:nProp], score[nProp:])), np.stack((energy[:nProp], energy[nProp:])), np.stack((variance[:nProp], variance[nProp:]))
+
+    def scoreConfigs(self, configs, model, useOracle):
+        """
+        compute score, energy and variance for a single batch of configurations
+        :param configs:
+        :return:
+        """
         if useOracle:
-            energy = [self.oracle.score(propConfig),self.oracle.score(config)]
-            variance = [[0 for _ in range(len(energy[0]))], [0 for _ in range(len(energy[1]))]]
-            score = self.scoreFunction[0] * np.asarray(energy) - self.scoreFunction[1] * np.asarray(variance)  # vary the relative importance of these two factors
+            energy = self.oracle.score(configs.astype(np.int64)) # oracles index with (token - 1), which would wrap around in uint8
+            variance = np.zeros_like(energy)
+            score = self.scoreFunction[0] * np.asarray(energy) - self.scoreFunction[1] * variance  # vary the relative importance of these two factors
         else:
             if (self.config_main.al.query_mode == 'learned') and ('DQN' in str(model.__class__)):
-                score = [model.evaluateQ(np.asarray(config)).cpu().detach().numpy(),model.evaluateQ(np.asarray(propConfig)).cpu().detach().numpy()] # evaluate the q-model
-                score = - np.array((score[1],score[0]))[:,:,0] # this code is a minimizer so we need to flip the sign of the Q scores
-                energy = [np.zeros_like(score[0]), np.zeros_like(score[1])] # energy and variance are irrelevant here
-                variance = [np.zeros_like(score[0]), np.zeros_like(score[1])]
+                score = - model.evaluateQ(configs).cpu().detach().numpy()[:,0] # evaluate the q-model - this code is a minimizer so we need to flip the sign of the Q scores
+                energy = np.zeros_like(score) # energy and variance are irrelevant here
+                variance = np.zeros_like(score)
             else: # manually specify score function
-                r1, r2 = [model.evaluate(np.asarray(config), output='Both'),model.evaluate(np.asarray(propConfig), output='Both')] # two model evaluations, each returning score and variance for a propConfig or config
-                energy = [r2[0], r1[0]]
-                variance = [r2[1], r1[1]]
+                energy, variance = model.evaluate(configs, output='Both') # returns score and variance for each config
 
                 # energy and variance both come out standardized against the training dataset
                 score = self.scoreFunction[0] * np.asarray(energy) - self.scoreFunction[1] * np.asarray(np.sqrt(variance))  # vary the relative importance of these two factors
 
-        return score, energy, variance
+        return np.asarray(score, dtype=np.float32), np.asarray(energy, dtype=np.float32), np.asarray(variance, dtype=np.float32)
 
 
     def saveOptima(self, ind, newBest):
         if len(self.allOptimalConfigs) == 0:
             [self.allOptimalConfigs.extend(i) for i in self.optimalSamples] # we don't want to duplicate any samples at all, if possible
-        equals = np.sum(self.propConfig[ind] == self.allOptimalConfigs,axis=1)
-        if (not any(equals == self.propConfig[ind].shape[-1])) or newBest: # if there are no copies or we know it's a new minimum, record it # bit slower to keep checking like this but saves us checks later
+            self.allOptimalKeys.update(sample.tobytes() for sample in self.allOptimalConfigs)
+        key = self.propConfig[ind].tobytes()
+        if (key not in self.allOptimalKeys) or newBest: # if there are no copies or we know it's a new minimum, record it
             self.optima[ind].append(self.scores[0][ind])
             self.enAtOptima[ind].append(self.energy[0][ind])
             self.varAtOptima[ind].append(self.variance[0][ind])
-            self.optimalSamples[ind].append(self.propConfig[ind])
-            self.allOptimalConfigs.append(self.propConfig[ind])
+            self.optimalSamples[ind].append(np.copy(self.propConfig[ind]))  # store copies rather than views into this step's proposal array
+            self.allOptimalConfigs.append(np.copy(self.propConfig[ind]))
+            self.allOptimalKeys.add(key)
         if newBest:
             self.E0[ind] = self.scores[0][ind]
             if self.E0[ind] < self.absMin: # if we find a new global minimum, use it
                 self.absMin = self.E0[ind]
-            self.newOptima[ind].append(self.propConfig[ind])
-            self.newOptimaEn[ind].append(self.energy[0][ind])
+            self.recordNewOptimum(ind, self.propConfig[ind], self.energy[0][ind])
             self.optimalInds[ind].append(self.iter)
+            self.lastOptimalInd[ind] = self.iter
+
+
+    def recordNewOptimum(self, ind, config, energy):
+        """
+        copy a new minimum into the preallocated per-chain records, doubling their capacity when full
+        :return:
+        """
+        count = self.newOptimaCount[ind]
+        if count == self.newOptima.shape[1]:
+            self.newOptima = np.concatenate((self.newOptima, np.zeros_like(self.newOptima)), axis=1)
+            self.newOptimaEn = np.concatenate((self.newOptimaEn, np.zeros_like(self.newOptimaEn)), axis=1)
+        self.newOptima[ind, count] = config
+        self.newOptimaEn[ind, count] = energy
+        self.newOptimaCount[ind] += 1
 
 
     def updateAnnealing(self):
@@ -366,20 +453,30 @@ class Sampler:
         # 1) if rejection rate is too high, switch to tunneling mode, if it is too low, switch to local search mode
         # acceptanceRate = len(self.stunRec)/self.iter # global acceptance rate
 
-        history = 100
-        for i in range(self.nruns):
-            acceptedRecently = np.sum((self.iter - np.asarray(self.recInds[i][-history:])) < history)  # rolling acceptance rate - how many accepted out of the last hundred iters
-            self.acceptanceRate[i] = acceptedRecently / history
+        self.acceptanceRate = self.acceptedBuf.mean(axis=1)  # rolling acceptance rate - fraction accepted out of the last hundred iters
+
+        rands = self.rng.random(self.nruns, dtype=np.float32)
+        self.temperature *= np.where(self.acceptanceRate < self.config_main.target_acceptance_rate, 1 + rands, 1 - rands) # modulate temperature semi-stochastically
+        np.maximum(self.temperature, np.finfo(np.float32).tiny, out=self.temperature) # don't let float32 temperatures underflow to zero
+
+        # if we haven't found a new minimum in a long time, randomize input and do a temperature boost
+        stale = ((self.iter - self.resetInd) > 1e3) & ((self.iter - self.lastOptimalInd) > 1e3) # within xx of the last reset, and haven't seen a new near-minimum in xx steps
+        for i in np.nonzero(stale)[0]:
+            self.resetConfig(i)  # re-randomize
+        self.resetInd[stale] = self.iter
+        self.temperature[stale] = self.temp0 # boost temperature
 
-            if self.acceptanceRate[i] < self.config_main.target_acceptance_rate:
-                self.temperature[i] = self.temperature[i] * (1 + np.random.random(1)[0]) # modulate temperature semi-stochastically
-            else:
-                self.temperature[i] = self.temperature[i] * (1 - np.random.random(1)[0])
 
-            # if we haven't found a new minimum in a long time, randomize input and do a temperature boost
-            if (self.iter - self.resetInd[i]) > 1e3:  # within xx of the last reset
-                if (self.iter - self.optimalInds[i][-1]) > 1e3: # haven't seen a new near-minimum in xx steps
-                    self.resetInd[i] = self.iter
-                    self.resetConfig(i)  # re-randomize
-                    self.temperature[i] = self.temp0 # boost temperature
+def parallelSample(config, seedInd, scoreFunction, gammas, model, nThreads, useOracle=False, nIters=None):
+    """
+    split the gammas over several independent samplers and run them in a thread pool
+    pytorch releases the GIL during model.evaluate, so one sampler's numpy work overlaps with another's forward pass
+    chains only exchange states (parallel tempering) within their own sampler
+    :return: optima records of all samplers, merged chain-wise as for a single sampler
+    """
+    nThreads = min(nThreads, len(gammas)) # every sampler needs at least one chain
+    samplers = [Sampler(config, seedInd, scoreFunction, group, rngStream=i) for i, group in enumerate(np.array_split(gammas, nThreads))]
+    with ThreadPoolExecutor(max_workers=nThreads) as executor:
+        outputs = list(executor.map(lambda sampler: sampler.sample(model, useOracle=useOracle, nIters=nIters), samplers))
 
+    return {key: [chain for output in outputs for chain in output[key]] for key in ['optima', 'enAtOptima', 'varAtOptima', 'optimalSamples']}